@@ -10,21 +10,14 @@ Significant modifications have been made to the original code to adapt it for ou
 
 import sys
 import math
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 import numpy as np
-from dna import DNA_ENERGIES
-from rna import RNA_ENERGIES
 from Types import Energies, Cache
 from graph_matching import  Aptamer_match
-from gm_energy_functions import _bulge, _hairpin, gm_multi_branch, all_combinations, open_ending_branch, _stack, _pair, _internal_loop, Struct
+from gm_energy_functions import best_open_ending_branch, _pair, Struct, OPEN_ENDING
+from gm_kernels import encode, energy_luts, isolated_masks, _fill, HAIRPIN, STACK, INTERIOR, MBRANCH, OPEN
 
 
-
-
-STRUCT_DEFAULT = Struct(-math.inf)
-STRUCT_NULL = Struct(math.inf)
-Structs = List[List[Struct]]
-
 def gm_s_matrix(seq: str, structs: List[Struct], size = None):
     """Compute structural matrix of the DNA sequence.
     Args:
@@ -42,14 +35,13 @@ def gm_s_matrix(seq: str, structs: List[Struct], size = None):
         
     M = np.zeros((n,n), dtype = int)
 
-    if structs[0].desc[:24] == "OPEN_ENDING_MULTI_BRANCH":
+    if structs[0].kind == OPEN_ENDING:
         structs = structs[1:]
         
-    for s in structs: 
-            if len(s.ij) == 1:
-                i, j = s.ij[0]
-                M[i,j] = 1
-                M[j,i] = 1
+    # base pairs of the faces, both (i,j) and (j,i) are set in one scatter
+    pairs = np.array([s.ij[0] for s in structs if len(s.ij) == 1], dtype=np.int32).reshape(-1, 2)
+    M[pairs[:, 0], pairs[:, 1]] = 1
+    M[pairs[:, 1], pairs[:, 0]] = 1
     return M
 
 def gmfold(seq: str, temp: float = 37.0, l_fix = 0, n_branches = 4, mode='dna') -> List[Struct]:
@@ -61,8 +53,10 @@ def gmfold(seq: str, temp: float = 37.0, l_fix = 0, n_branches = 4, mode='dna')
         n_branches: amount of branches to consider when computing multi-branch loops
     Returns:
         List[Struct]: A list of structures. Stacks, bulges, hairpins, etc.
+    Raises:
+        ValueError: if no base pair can form in the sequence, or the initial stem of length l_fix cannot form
     """
-    
+
     # Solve graph matching problem
     APT = Aptamer_match(mode=mode)
     APT.fit_fold( sequence=seq ,  n_tmpl=4, l_fix= l_fix )
@@ -70,28 +64,37 @@ def gmfold(seq: str, temp: float = 37.0, l_fix = 0, n_branches = 4, mode='dna')
     D = APT.dict_d
     bps = APT.bps
 
-    # Fill e_cache
-    e_cache,   min_struct, min_ene= _cache(seq, temp, S, D, l_fix=l_fix, n_branches= n_branches, mode=mode)
+    # Fill the energy cache
+    cache, min_i, min_j, min_ene = _cache(seq, temp, S, D, l_fix=l_fix, n_branches= n_branches, mode=mode)
+    E, DESC, BP_I, BP_J = cache
     
     n = len(seq)
-    branches = []   
     # Compute energy of configurations ending with an open loop    
-    if (e_cache[0][n-1].e > min_ene or e_cache[0][n-1]== STRUCT_DEFAULT) and l_fix == 0:
+    if (E[0, n-1] > min_ene or E[0, n-1] == -math.inf) and l_fix == 0:
         
-        # Exclude branches with positive energy value
-        for bp in list(set(bps)):
-                if e_cache[bp[0]][bp[1]].e < 0:
-                    branches.append(bp)
+        # Exclude branches with positive energy value. The order of the set decides between combinations with the same energy
+        bps = np.array(list(set(bps)), dtype=np.int32).reshape(-1, 2)
+        energies = E[bps[:, 0], bps[:, 1]]
+        branches = [tuple(bp) for bp in bps[energies < 0].tolist()]
                     
-        # Compute energy all possible compatible branches configurations consisting up to n_branches
-        combos = all_combinations(branches, r2 =n_branches)  
-        for combo in combos:                         
-                        e3_test =  open_ending_branch(e_cache, combo)
-                        if e3_test and e3_test.e < e_cache[min_struct[0]][min_struct[1]].e:
-                                e_cache[0][n-1] = e3_test
-                                min_struct = (0,n-1)           
+        # Find the lowest energy configuration of compatible branches consisting up to n_branches
+        e3_test = best_open_ending_branch(E, branches, energies[energies < 0].tolist(), r2=n_branches, e_max=min_ene)
+        if e3_test:
+                E[0, n-1] = e3_test.e
+                DESC[0, n-1] = OPEN
+                BP_I[0, n-1] = -1
+                BP_J[0, n-1] = -1
+                BP_I[0, n-1, :len(e3_test.ij)] = [bp[0] for bp in e3_test.ij]
+                BP_J[0, n-1, :len(e3_test.ij)] = [bp[1] for bp in e3_test.ij]
+                min_i, min_j = 0, n-1
+
+    if l_fix > 0 and not math.isfinite(E[0, n-1]):
+        raise ValueError(f'the initial stem of length {l_fix} cannot form in {seq}')
+
+    if min_i < 0:
+        raise ValueError(f'no base pair can form in {seq}, the sequence does not fold')
 
-    return gm_traceback(min_struct[0], min_struct[1], e_cache, l_fix)
+    return gm_traceback(min_i, min_j, seq.upper(), cache, l_fix)
 
 
 
@@ -104,254 +107,134 @@ def gm_dot_bracket(seq: str, structs: List[Struct]) -> str:
         str: the dot bracket notation of the secondary structure
     """
 
-    result = ["."] * len(seq)
+    result = bytearray(b"." * len(seq))
     #If ending with open loop do not consider the first structure
-    if structs[0].desc[:24] == "OPEN_ENDING_MULTI_BRANCH":
+    if structs[0].kind == OPEN_ENDING:
         structs = structs[1:]
         
     for s in structs:
             if len(s.ij) == 1:
                 i, j = s.ij[0]
-                result[i] = "("
-                result[j] = ")"
-    return "".join(result)
+                result[i] = ord("(")
+                result[j] = ord(")")
+    return result.decode()
+
+
+def _flatten_D(D, n: int):
+    """Flatten the dictionary D into int32 arrays (D_ptr, D_bp_i, D_bp_j) sorted by length d = j-i and then by i.
+    The base pairs with length d are D_bp_i[k], D_bp_j[k] for k in range(D_ptr[d], D_ptr[d+1]).
+    """
 
+    D_ptr = np.zeros(n + 1, dtype=np.int32)
+    for d, bps in D.items():
+        D_ptr[d + 1] = len(bps)
+    np.cumsum(D_ptr, out=D_ptr)
+    bps = np.concatenate([np.empty((0, 2), dtype=np.int32), *D.values()])
+    return D_ptr, bps[:, 0].copy(), bps[:, 1].copy()
 
-def _cache(seq: str, temp: float = 37.0, S= None, D = None, l_fix = 0, n_branches = None, mode='dna') :
-    """Create and fill the e_cache
+def _flatten_S(S, D_bp_i, D_bp_j, n: int):
+    """Flatten the dictionary S into int32 arrays (S_ptr, S_bp_i, S_bp_j). The base pairs (i',j') such that i<i'<j'<j
+    are S_bp_i[k], S_bp_j[k] for k in range(S_ptr[i*n+j], S_ptr[i*n+j+1]), in the same order as in S.
+    """
+
+    cells = D_bp_i.astype(np.int64) * n + D_bp_j
+    order = np.argsort(cells)
+    inner = [S['({}, {})'.format(D_bp_i[k], D_bp_j[k])] for k in order]
+    S_ptr = np.zeros(n * n + 1, dtype=np.int32)
+    S_ptr[cells[order] + 1] = [len(bps) for bps in inner]
+    np.cumsum(S_ptr, out=S_ptr)
+    flat = np.array([bp for bps in inner for bp in bps], dtype=np.int32).reshape(-1, 2)
+    return S_ptr, flat[:, 0].copy(), flat[:, 1].copy()
+
+def _cache(seq: str, temp: float = 37.0, S = None, D = None, l_fix = 0, n_branches = None, mode='dna') :
+    """Create and fill the energy cache
     Args:
         seq: The sequence to fold
         temp: The temperature to fold at
         S: dictionary containing, for each base pair (i,j) all possible base pairs (i',j') such that i<i'<j'<j.
-        D: dictionary containing for each possible length d all base pairs with length d identified solving the subgraph matching problem
+        D: dictionary containing for each possible length d, in ascending order, the m x 2 array of all base pairs with length d identified solving the subgraph matching problem
         l_fix: length of initial stem. Forces the first l_fix nucleotides to base pair with the last l_fix nucleotides.
         n_branches: amount of branches to consider when computing multi-branch loops
 
     Returns:
-        Structs: filled  e_cache 
+        cache: tuple (E, DESC, BP_I, BP_J) with, for each (i,j), the free energy where i and j bond (-inf if (i,j) is not a base pair),
+            the type of the optimal face and its inner base pairs (i',j') padded with -1
+        min_i, min_j: base pair with the minimum free energy, -1 if there is none
+        min_ene: the minimum free energy
     """
 
     seq = seq.upper()
     temp = temp + 273.15  # kelvin
 
-    # Set DNA energies. By changing these energies the following code can ptentially be used for RNA sequences
-    if mode == 'dna':
-        emap = DNA_ENERGIES 
-    elif mode == 'rna':
-        emap = RNA_ENERGIES 
-    else:
-        raise(ValueError, f'mode must be either [dna, rna] but found value {mode}')
+    # The energies are set by mode. By changing these energies the following code can ptentially be used for RNA sequences
+    if mode not in ('dna', 'rna'):
+        raise ValueError(f'mode must be either [dna, rna] but found value {mode}')
     n = len(seq)
-    e_cache: Structs = []
 
-    for _ in range(n):
-        e_cache.append([STRUCT_DEFAULT] * n)
-    
-    # fill e_cache
-    non_branches = set([])
-    min_ene = np.inf
-    min_struct = None
-    
-    # if not stem
-    if l_fix ==0:
-        for d in sorted(list(D.keys()), key= int):
-            for bp in set(D[d]):
-                e, non_branches =  _e(seq, bp[0], bp[1], temp, e_cache, emap, S, non_branches, n_branches)
-                if e.e  < min_ene:
-                    min_struct = bp
-                    min_ene = e.e
-    #if stem
-    if l_fix >0:
-        fixed_bp = [(k,n-1-k) for k in range(l_fix-1)]
-        for d in sorted(list(D.keys()), key= int):
-            for bp in set(D[d]):
-                if bp in fixed_bp:
-                    i = bp[0]
-                    j = bp[1]
-                    i1 = i+1
-                    j1 = j-1
-                    # i1 and j1 must match
-                    if emap.COMPLEMENT[seq[i1]] != seq[j1]:
-                        continue
-                    e2 = Struct(math.inf)
-                    pair = _pair(seq, i, i1, j, j1)
-                    e2_test, e2_test_type = math.inf, ""
-                    # it's a neighboring/stacking pair in a helix
-                    e2_test = _stack(seq, i, i1, j, j1, temp, emap)
-                    e2_test_type = f"STACK:{pair}"
-                    if i > 0 and j == n - 1 or i == 0 and j < n - 1:
-                        # there's a dangling end
-                        e2_test_type = f"STACK_DE:{pair}"
-                    e2_test += e_cache[i1][j1].e
-                    if e2_test != -math.inf and e2_test < e2.e:
-                        e2= Struct(e2_test, e2_test_type, [(i1, j1)])
-                    e_cache[i][j] = e2
-                else:
-                    e, non_branches =  _e(seq, bp[0], bp[1], temp, e_cache, emap, S, non_branches, n_branches)
-                if e.e  < min_ene:
-                    min_struct = bp
-                    min_ene = e.e
-
-    return e_cache,  min_struct, min_ene
-
-
-
-def _e(
-    seq: str,
-    i: int,
-    j: int,
-    temp: float,
-    e_cache: Structs,
-    emap: Energies,
-    S,
-    non_branches = set,
-    n_branches = None
-):
-    """Find, store and return the minimum free energy of the structure between i and j
-    Args:
-        seq: The sequence being folded
-        i: The start index
-        j: The end index (inclusive)
-        temp: The temperature in Kelvin
-        e_cache: Free energy cache for if i and j bp. INF otherwise
-        emap: Energy map for DNA
-        S: dictionary containing, for each base pair (i,j) all possible base pairs (i',j') such that i<i'<j'<j.
-        non_branches: set of base pairs (i,j) to not consider as possible branches when computing multi_branch loops
-        n_branches: amount of branches to consider when computing multi-branch loops
-    Returns:
-        float: The minimum energy folding structure possible between i and j on seq
-    """
-    
-    if e_cache[i][j] != STRUCT_DEFAULT:
-        return e_cache[i][j]
-    
-    
-    # if the basepair is isolated, and the seq large, penalize at 1,600 kcal/mol
-    # heuristic for speeding this up
-    # from https://www.ncbi.nlm.nih.gov/pubmed/10329189
-    isolated_outer = True
-    if i and j < len(seq) - 1:
-        isolated_outer = emap.COMPLEMENT[seq[i - 1]] != seq[j + 1]
-    isolated_inner = emap.COMPLEMENT[seq[i + 1]] != seq[j - 1]
-
-    if isolated_outer and isolated_inner:
-        e_cache[i][j] = Struct(5000)#1600)
-        return e_cache[i][j]
-    
-    # E1 = FH(i, j); hairpin
-    pair = _pair(seq, i, i + 1, j, j - 1)
-    e1 = Struct(_hairpin(seq, i, j, temp, emap), "HAIRPIN:" + pair)
-    if j - i == 4:  # small hairpin; 4bp
-        e_cache[i][j] = e1
-        return e_cache[i][j], non_branches
-
-    # E2 = min{FL(i, j, i', j') + e(i', j')}, i<i'<j'<j
-    n = len(seq)
-    e2 = Struct(math.inf)
-    key = '({}, {})'.format(*(i,j))
-    for bp in S[key]:
-            i1 = bp[0]
-            j1 = bp[1]
-            
-            # i1 and j1 must match
-            if emap.COMPLEMENT[seq[i1]] != seq[j1]:
-                continue
-
-            pair = _pair(seq, i, i1, j, j1)
-            pair_left = _pair(seq, i, i + 1, j, j - 1)
-            pair_right = _pair(seq, i1 - 1, i1, j1 + 1, j1)
-            pair_inner = pair_left in emap.NN or pair_right in emap.NN
-
-            stack = i1 == i + 1 and j1 == j - 1
-            bulge_left = i1 > i + 1
-            bulge_right = j1 < j - 1
-
-            e2_test, e2_test_type = math.inf, ""
-            if stack:
-                # it's a neighboring/stacking pair in a helix
-                e2_test = _stack(seq, i, i1, j, j1, temp, emap)
-                e2_test_type = f"STACK:{pair}"
-
-                if i > 0 and j == n - 1 or i == 0 and j < n - 1:
-                    # there's a dangling end
-                    e2_test_type = f"STACK_DE:{pair}"
-            elif bulge_left and bulge_right and not pair_inner:
-                # it's an interior loop
-                e2_test = _internal_loop(seq, i, i1, j, j1, temp, emap)
-                e2_test_type = f"INTERIOR_LOOP:{str(i1 - i)}/{str(j - j1)}"
-
-                if i1 - i == 2 and j - j1 == 2:
-                    loop_left = seq[i : i1 + 1]
-                    loop_right = seq[j1 : j + 1]
-                    # technically an interior loop of 1. really 1bp mismatch
-                    e2_test_type = f"STACK:{loop_left}/{loop_right[::-1]}"
-            elif bulge_left and not bulge_right:
-                # it's a bulge on the left side
-                e2_test = _bulge(seq, i, i1, j, j1, temp, emap)
-                e2_test_type = f"BULGE:{str(i1 - i)}"
-            elif not bulge_left and bulge_right:
-                # it's a bulge on the right side
-                e2_test = _bulge(seq, i, i1, j, j1, temp, emap)
-                e2_test_type = f"BULGE:{str(j - j1)}"
-            else:
-                # it's basically a hairpin, only outside bp match
-                continue
-
-            # add e(i', j')
-            e2_test += e_cache[i1][j1].e
-            if e2_test != -math.inf and e2_test < e2.e:
-                e2 = Struct(e2_test, e2_test_type, [(i1, j1)])
-            
-
-    # E3 = min{FB(i, j, branches) + \sum_{(i',j') \in branches}e(i', j')} with i<i'<j'<j
-    e3 = STRUCT_NULL
-    
-    if not isolated_outer or not i or j == len(seq) - 1:
-        branches = list( set(S[key])-non_branches) #Consider all  i<i'<j'<j and remove those that cannot be branches 
-            
-        if len(branches)>=2:
-            combos = all_combinations(branches, r1=2, r2=n_branches )
-            
-            for combo in combos: 
-                    e3_test = gm_multi_branch(seq, i, j, temp, e_cache, emap, list(combo))
-                    
-                    if e3_test and e3_test.e < e3.e:
-                            e3 = e3_test                                  
-    e = _min_struct(e1, e2, e3) 
-    
-    # If face has positive energy, is a multi-branch or an hairpin, it is not considered as a branch candidate in multi-branch loops
-    if e.e >0 or e == e3 or e ==e1:
-        non_branches.add((i,j)) 
-    
-    e_cache[i][j] = e
+    # fill E diagonal by diagonal
+    enc = encode(seq, mode)
+    D = _flatten_D(D, n)
+    S = _flatten_S(S, D[1], D[2], n)
+    ISO_OUT, ISO_IN = isolated_masks(enc)
+    E, DESC, BP_I, BP_J, min_i, min_j, min_ene = _fill(enc, S, D, l_fix, n_branches, ISO_OUT, ISO_IN, energy_luts(temp, n, mode))
 
-    return e, non_branches
+    return (E, DESC, BP_I, BP_J), int(min_i), int(min_j), float(min_ene)
 
 
 
-def _min_struct(*structs: Struct) -> Struct:
-    """Return the struct with the lowest free energy that isn't -inf (undef)
+def _struct_at(seq: str, i: int, j: int, cache) -> Struct:
+    """Build the Struct of the face closed by (i,j) from the energy cache
 
     Args:
-        structs: Structures being compared
+        seq: The sequence being folded, in capital letters
+        i: The start index
+        j: The end index (inclusive)
+        cache: tuple (E, DESC, BP_I, BP_J) returned by _cache
 
     Returns:
-        struct: The min free energy structure
+        Struct: the face with its free energy, description and inward children
     """
 
-    s: Struct = STRUCT_NULL
-    for struct in structs:
-        if struct.e != -math.inf and struct.e < s.e:
-            s = struct
-    return s
+    E, DESC, BP_I, BP_J = cache
+    n = len(seq)
+    e = float(E[i, j])
+    desc = DESC[i, j]
+    ij = [(i1, j1) for i1, j1 in zip(BP_I[i, j].tolist(), BP_J[i, j].tolist()) if i1 >= 0]
+
+    if desc == HAIRPIN:
+        return Struct(e, "HAIRPIN:" + _pair(seq, i, i + 1, j, j - 1))
+    if desc == MBRANCH:
+        unpaired = j - i - 1 - sum(j1 - i1 + 1 for i1, j1 in ij)
+        return Struct(e, f"BIFURCATION:{str(unpaired)}n/{str(len(ij) + 1)}h", ij)
+    if desc == OPEN:
+        return Struct(e, f"OPEN_ENDING_MULTI_BRANCH:{str(len(ij))}h", ij, OPEN_ENDING)
+    if not ij:
+        return Struct(e)
+
+    i1, j1 = ij[0]
+    pair = _pair(seq, i, i1, j, j1)
+    if desc == STACK:
+        desc = f"STACK:{pair}"
+        if i > 0 and j == n - 1 or i == 0 and j < n - 1:
+            # there's a dangling end
+            desc = f"STACK_DE:{pair}"
+    elif desc == INTERIOR:
+        desc = f"INTERIOR_LOOP:{str(i1 - i)}/{str(j - j1)}"
+        if i1 - i == 2 and j - j1 == 2:
+            # technically an interior loop of 1. really 1bp mismatch
+            desc = f"STACK:{seq[i : i1 + 1]}/{seq[j1 : j + 1][::-1]}"
+    else:
+        desc = f"BULGE:{str(max(i1 - i, j - j1))}"
+    return Struct(e, desc, ij)
 
-def gm_traceback(i: int, j: int, e_cache: Structs, l_fix) -> List[Struct]:
+def gm_traceback(i: int, j: int, seq: str, cache, l_fix) -> List[Struct]:
     """Traceback thru the e(i,j) caches to find the structure with minimal free energy
 
     Args:
         i: The leftmost index to start searching in
         j: The rightmost index to start searching in
-        e_cache: Energies where i and j bond
+        seq: The sequence being folded, in capital letters
+        cache: tuple (E, DESC, BP_I, BP_J) returned by _cache
         l_fix: length of initial stem. Forces the first l_fix nucleotides to base pair with the last l_fix nucleotides.
 
     Returns:
@@ -359,56 +242,45 @@ def gm_traceback(i: int, j: int, e_cache: Structs, l_fix) -> List[Struct]:
     """
 
     
+    E = cache[0]
     structs: List[Struct] = []
-    if l_fix > 1:
-        for k in range(1,l_fix): # if stem the e(i,j) pints at e(i+1,j-1) for (i,j) that  are in the stem
-            s = e_cache[k-1][len(e_cache)-k]
-            s.ij[0] = k, len(e_cache)-1-k
+    if l_fix > 0: # if stem the e(i,j) pints at e(i+1,j-1) for (i,j) that  are in the stem
         i = 0 
-        j = len(e_cache)-1
-            
-    elif l_fix == 1:
-        i = 0
-        j = len(e_cache)-1 
-
-    while True:
-        s = e_cache[i][j]
-        structs.append(s.with_ij([(i, j)]))
+        j = len(E)-1
+
+    # The structure is a tree of chains of nested faces: a chain ends with a hairpin or with a multi-branch,
+    # whose branches start new chains. They are visited depth first, branches in order, as a recursion would.
+    ends: Dict[int, float] = {}
+    stack = [(i, j)]
+    while stack:
+        i, j = stack.pop()
+        while True:
+            s = _struct_at(seq, i, j, cache)
+            structs.append(s.with_ij([(i, j)]))
+
+            # it's a stack, bulge, etc
+            # there's another single structure beyond this
+            if len(s.ij) != 1:
+                break
+            i, j = s.ij[0]
 
         # it's a hairpin, end of structure
-        if not s.ij:
-            # set the energy of everything relative to the hairpin
-            return _trackback_energy(structs)
-
-        # it's a stack, bulge, etc
-        # there's another single structure beyond this
-        if len(s.ij) == 1:
-            i, j = s.ij[0]
-            continue
-        
-        # it's a multibranch
         e_sum = 0.0
-        structs = _trackback_energy(structs)
-        branches: List[Struct] = []
-        for i1, j1 in s.ij:
-            tb = gm_traceback(i1, j1, e_cache, 0)
-            if tb and tb[0].ij:
-                e_sum += e_cache[i1][j1].e
-                branches += tb
-        
-        last = structs[-1]
-        structs[-1] = Struct(round(last.e - e_sum, 1), last.desc, list(last.ij))
-        
-        
-        return structs + branches
+        if s.ij:
+            # it's a multibranch, its energy doesn't include the one of the branches
+            for i1, j1 in s.ij:
+                e_sum += float(E[i1, j1])
+            stack.extend(reversed(s.ij))
+        ends[len(structs) - 1] = e_sum
 
-    return _trackback_energy(structs)
+    return _trackback_energy(structs, ends)
 
-def _trackback_energy(structs: List[Struct]) -> List[Struct]:
+def _trackback_energy(structs: List[Struct], ends: Dict[int, float]) -> List[Struct]:
     """Add energy to each structure, based on how the e(i,j) differs from the one after
 
     Args:
         structs: The structures for whom energy is being calculated
+        ends: for the last structure of each chain, the energy of the branches that follow it (0.0 after a hairpin)
 
     Returns:
         List[Struct]: Structures in the folded DNA with energy
@@ -416,8 +288,9 @@ def _trackback_energy(structs: List[Struct]) -> List[Struct]:
 
     structs_e: List[Struct] = []
     for index, struct in enumerate(structs):
-        e_next = 0.0 if index == len(structs) - 1 else structs[index + 1].e
-        structs_e.append(
-            Struct(round(struct.e - e_next, 1), struct.desc, list(struct.ij))
-        )
+        if index in ends:
+            e = round(round(struct.e, 1) - ends[index], 1)
+        else:
+            e = round(struct.e - structs[index + 1].e, 1)
+        structs_e.append(Struct(e, struct.desc, list(struct.ij), struct.kind))
     return structs_e
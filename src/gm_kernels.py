@@ -0,0 +1,723 @@
+"""Numba kernels used by gmfold to fill the energy cache.
+
+The face energy functions are based on code from the following open-source repository:
+Repository: https://github.com/Lattice-Automation/seqfold
+License: MIT License
+Accessed: 20 July 2024.
+
+The energy maps are dictionaries keyed by strings, which cannot be compiled with numba. Here the sequence is
+encoded as integers (A, C, G, T/U -> 0, 1, 2, 3 and 4 for a dangling end ".") and the energy maps are
+materialized once per fold as float64 lookup tables, so that the dynamic programming over (i,j) runs without
+the Python interpreter.
+"""
+
+import math
+from functools import lru_cache
+import numpy as np
+from numba import njit, prange
+from dna import DNA_ENERGIES
+from rna import RNA_ENERGIES
+from gm_energy_functions import _d_g, _j_s, OPEN_ENDING
+
+GAP = 4 # code of a dangling end, "." in the energy maps
+ISOLATED_PENALTY = 5000.0
+N_DANGLES = 6 # dangling end energies stored per base pair, see _dangles
+
+# Face types stored in DESC, 0 if (i,j) is not a base pair, isolated or has no valid face
+HAIRPIN = 1
+STACK = 2
+BULGE = 3
+INTERIOR = 4
+MBRANCH = 5
+OPEN = OPEN_ENDING
+
+
+# bytes.translate tables from ASCII to the nucleotide codes, 255 (-1 as int8) for any other character
+_CODES = {
+    mode: bytes(alphabet.find(chr(c)) % 256 for c in range(256))
+    for mode, alphabet in (('dna', 'ACGT'), ('rna', 'ACGU'))
+}
+
+
+def encode(seq: str, mode: str = 'dna') -> np.ndarray:
+    """Encode a nucleotide sequence as an int8 array.
+    Args:
+        seq: The sequence to encode, in capital letters
+        mode: Either dna or rna
+    Returns:
+        np.ndarray: codes 0..3 for A, C, G, T (U if rna). Complementary nucleotides sum up to 3.
+    """
+
+    return np.frombuffer(seq.encode().translate(_CODES[mode]), dtype=np.int8)
+
+
+def isolated_masks(enc: np.ndarray) -> tuple:
+    """Flag, for every (i,j), whether the outer (i-1,j+1) and inner (i+1,j-1) neighbours do not pair.
+    Args:
+        enc: The encoded sequence
+    Returns:
+        ISO_OUT, ISO_IN: n x n boolean matrices. ISO_OUT is True on the edges of the sequence (i = 0 or j = n-1).
+    """
+
+    n = enc.shape[0]
+    ISO_OUT = np.ones((n, n), dtype=np.bool_)
+    ISO_IN = np.ones((n, n), dtype=np.bool_)
+    # complementary nucleotides sum up to 3
+    ISO_OUT[1:, :-1] = enc[:-1, None] + enc[None, 1:] != 3
+    ISO_IN[:-1, 1:] = enc[1:, None] + enc[None, :-1] != 3
+    return ISO_OUT, ISO_IN
+
+
+def _pair_lut(energies, alphabet: str, temp: float) -> np.ndarray:
+    """Convert a map of pair energies (keys as "AC/TG") into a 5x5x5x5 table of free energies. Missing pairs are NaN."""
+
+    symbols = alphabet + '.'
+    lut = np.full((5, 5, 5, 5), np.nan)
+    for key, (d_h, d_s) in energies.items():
+        if len(key) != 5 or key[2] != '/' or any(c not in symbols for c in key[:2] + key[3:]):
+            continue
+        a, b, c, d = (symbols.index(k) for k in key[:2] + key[3:])
+        lut[a, b, c, d] = _d_g(d_h, d_s, temp)
+    return lut
+
+
+def _loop_lut(energies, temp: float, n: int) -> np.ndarray:
+    """Free energy of a loop for each length up to n. Lengths above 30 are extrapolated with _j_s."""
+
+    lut = np.full(n + 1, np.nan)
+    for loop_len in range(1, n + 1):
+        if loop_len in energies:
+            d_h, d_s = energies[loop_len]
+            lut[loop_len] = _d_g(d_h, d_s, temp)
+        else:
+            d_h, d_s = energies[30]
+            lut[loop_len] = _j_s(loop_len, 30, _d_g(d_h, d_s, temp), temp)
+    return lut
+
+
+def _tri_tetra_lut(energies, alphabet: str, temp: float) -> np.ndarray:
+    """Free energy of the known tri and tetra loops, indexed by the base 4 encoding of the hairpin."""
+
+    lut = np.full((2, 4 ** 6), np.nan)
+    if not energies:
+        return lut
+    for hairpin, (d_h, d_s) in energies.items():
+        if any(c not in alphabet for c in hairpin):
+            continue
+        key = 0
+        for c in hairpin:
+            key = key * 4 + alphabet.index(c)
+        lut[len(hairpin) - 5, key] = _d_g(d_h, d_s, temp)
+    return lut
+
+
+ENERGIES = {'dna': DNA_ENERGIES, 'rna': RNA_ENERGIES}
+LOOP_LUT_MIN = 128 # smallest length the loop tables are built for, they grow by doubling
+
+
+@lru_cache(maxsize=None)
+def _pair_luts(mode: str, temp: float) -> tuple:
+    """Tables that don't depend on the sequence: (NN, INTERNAL_MM, TERMINAL_MM, DE, TRI_TETRA_LOOPS, MULTIBRANCH)"""
+
+    emap = ENERGIES[mode]
+    alphabet = 'ACGT' if mode == 'dna' else 'ACGU'
+    return (
+        _pair_lut(emap.NN, alphabet, temp),
+        _pair_lut(emap.INTERNAL_MM, alphabet, temp),
+        _pair_lut(emap.TERMINAL_MM, alphabet, temp),
+        _pair_lut(emap.DE, alphabet, temp),
+        _tri_tetra_lut(emap.TRI_TETRA_LOOPS, alphabet, temp),
+        np.array(emap.MULTIBRANCH, dtype=np.float64),
+    )
+
+
+@lru_cache(maxsize=None)
+def _loop_luts(mode: str, temp: float, size: int) -> tuple:
+    """Tables of the loop energies for each length up to size: (HAIRPIN_LOOPS, BULGE_LOOPS, INTERNAL_LOOPS)"""
+
+    emap = ENERGIES[mode]
+    return (
+        _loop_lut(emap.HAIRPIN_LOOPS, temp, size),
+        _loop_lut(emap.BULGE_LOOPS, temp, size),
+        _loop_lut(emap.INTERNAL_LOOPS, temp, size),
+    )
+
+
+def energy_luts(temp: float, n: int, mode: str = 'dna') -> tuple:
+    """Materialize the energy maps as lookup tables for the numba kernels.
+
+    The tables are built once per mode and temperature and shared by all the folds, so they must not be
+    modified. The loop tables cover lengths up to the smallest LOOP_LUT_MIN * 2^k not below n.
+
+    Args:
+        temp: The temperature in Kelvin
+        n: Length of the sequence to fold
+        mode: Either dna or rna
+    Returns:
+        tuple: (NN, INTERNAL_MM, TERMINAL_MM, DE, HAIRPIN_LOOPS, BULGE_LOOPS, INTERNAL_LOOPS, TRI_TETRA_LOOPS, MULTIBRANCH)
+    """
+
+    size = LOOP_LUT_MIN
+    while size < n:
+        size *= 2
+    NN, INTERNAL_MM, TERMINAL_MM, DE, TRI_TETRA_LOOPS, MULTIBRANCH = _pair_luts(mode, temp)
+    HAIRPIN_LOOPS, BULGE_LOOPS, INTERNAL_LOOPS = _loop_luts(mode, temp, size)
+    return (NN, INTERNAL_MM, TERMINAL_MM, DE, HAIRPIN_LOOPS, BULGE_LOOPS, INTERNAL_LOOPS, TRI_TETRA_LOOPS, MULTIBRANCH)
+
+
+@njit(cache=True)
+def _code(enc, k):
+    return enc[k] if k >= 0 else GAP
+
+
+@njit(cache=True)
+def _nn_or(nn, other, a, b, c, d):
+    e = nn[a, b, c, d]
+    if np.isnan(e):
+        e = other[a, b, c, d]
+    return e
+
+
+@njit(cache=True)
+def _stack(enc, i, i1, j, j1, luts):
+    """Free energy of the stack of the pairs (i,j) and (i1,j1)
+
+    An index of -1 marks a dangling end. A pair where i XOR j is at the sequence's end also gets
+    the energy of its dangling end.
+    """
+
+    NN, INTERNAL_MM, TERMINAL_MM, DE = luts[0], luts[1], luts[2], luts[3]
+    n = enc.shape[0]
+    if i >= n or i1 >= n or j >= n or j1 >= n:
+        return 0.0
+
+    a, b, c, d = _code(enc, i), _code(enc, i1), _code(enc, j), _code(enc, j1)
+    if i == -1 or i1 == -1 or j == -1 or j1 == -1:
+        # it's a dangling end
+        return DE[a, b, c, d]
+
+    if i > 0 and j < n - 1:
+        # it's internal
+        return _nn_or(NN, INTERNAL_MM, a, b, c, d)
+
+    if i == 0 and j == n - 1:
+        # it's terminal
+        return _nn_or(NN, TERMINAL_MM, a, b, c, d)
+
+    if i > 0 and j == n - 1:
+        # it's dangling on left
+        d_g = _nn_or(NN, TERMINAL_MM, a, b, c, d)
+        de = DE[enc[i - 1], enc[i], GAP, enc[j]]
+        if not np.isnan(de):
+            d_g += de
+        return d_g
+
+    if i == 0 and j < n - 1:
+        # it's dangling on right
+        d_g = _nn_or(NN, TERMINAL_MM, a, b, c, d)
+        de = DE[GAP, enc[i], enc[j + 1], enc[j]]
+        if not np.isnan(de):
+            d_g += de
+        return d_g
+
+    return 0.0
+
+
+@njit(cache=True)
+def _hairpin(enc, i, j, luts):
+    """Free energy of a hairpin closed by (i,j), math.inf if the loop has less than 3 bases"""
+
+    TERMINAL_MM, HAIRPIN_LOOPS, TRI_TETRA_LOOPS = luts[2], luts[4], luts[7]
+    if j - i < 4:
+        return math.inf
+
+    hairpin_len = j - i - 1
+    d_g = 0.0
+    if hairpin_len == 3 or hairpin_len == 4:
+        # it's a pre-known hairpin with known value
+        key = 0
+        for k in range(i, j + 1):
+            key = key * 4 + enc[k]
+        tt = TRI_TETRA_LOOPS[hairpin_len - 3, key]
+        if not np.isnan(tt):
+            d_g = tt
+
+    # add penalty based on size
+    d_g += HAIRPIN_LOOPS[hairpin_len]
+
+    # add penalty for a terminal mismatch
+    if hairpin_len > 3:
+        tmm = TERMINAL_MM[enc[i], enc[i + 1], enc[j], enc[j - 1]]
+        if not np.isnan(tmm):
+            d_g += tmm
+
+    # add penalty if length 3 and AT closing, formula 8 from SantaLucia, 2004
+    if hairpin_len == 3 and (enc[i] == 0 or enc[j] == 0):
+        d_g += 0.5
+
+    return d_g
+
+
+@njit(cache=True)
+def _bulge(enc, i, i1, j, j1, luts):
+    """Free energy of a bulge between the pairs (i,j) and (i1,j1)"""
+
+    loop_len = max(i1 - i - 1, j - j1 - 1)
+    d_g = luts[5][loop_len]
+
+    if loop_len == 1:
+        # if len 1, include the delta G of intervening NN (SantaLucia 2004)
+        d_g += _stack(enc, i, i1, j, j1, luts)
+
+    # penalize AT terminal bonds
+    if enc[i] == 0 or enc[i1] == 0 or enc[j] == 0 or enc[j1] == 0:
+        d_g += 0.5
+
+    return d_g
+
+
+@njit(cache=True)
+def _internal_loop(enc, i, i1, j, j1, luts):
+    """Free energy of an internal loop between the pairs (i,j) and (i1,j1)
+
+    This is adapted from the "Internal Loops" section of SantaLucia/Hicks, 2004. Unlike in seqfold,
+    a single bp mismatch is the sum of the two single mismatch pairs.
+    """
+
+    TERMINAL_MM = luts[2]
+    loop_left = i1 - i - 1
+    loop_right = j - j1 - 1
+    loop_len = loop_left + loop_right
+
+    # single bp mismatch, sum up the two single mismatch pairs
+    if loop_left == 1 and loop_right == 1:
+        mm_left = _stack(enc, i, i1 - 1, j, j1 + 1, luts)
+        mm_right = _stack(enc, i1 - 1, i1, j1 + 1, j1, luts)
+        return mm_left + mm_right
+
+    # apply a penalty based on loop size
+    d_g = luts[6][loop_len]
+
+    # apply an asymmetry penalty
+    d_g += 0.3 * abs(loop_left - loop_right)
+
+    # apply penalty based on the mismatching pairs on either side of the loop
+    d_g += TERMINAL_MM[enc[i], enc[i + 1], enc[j], enc[j - 1]]
+    d_g += TERMINAL_MM[enc[i1 - 1], enc[i1], enc[j1 + 1], enc[j1]]
+
+    return d_g
+
+
+@njit(cache=True)
+def _dangles(enc, i, j, luts):
+    """Dangling end energies of the base pair (i,j) in a multi-branch loop
+
+    They don't depend on the other branches, so they are computed once per fold and reused by every
+    combination of branches _multi_branch is evaluated on.
+
+    Returns:
+        array: The energies with unpaired bases on both sides, on the 3' side only and on the 5' side only,
+            when (i,j) is a branch (0, 1, 2) and when it closes the loop (3, 4, 5)
+    """
+
+    de = np.empty(N_DANGLES)
+    de[0] = _stack(enc, i - 1, i, j + 1, j, luts)
+    de[1] = _stack(enc, -1, i, j + 1, j, luts)
+    de[2] = _stack(enc, i - 1, i, -1, j, luts)
+    de[3] = _stack(enc, j - 1, j, i + 1, i, luts)
+    de[4] = _stack(enc, -1, j, i + 1, i, luts)
+    de[5] = _stack(enc, j - 1, j, -1, i, luts)
+    return de
+
+
+@njit(cache=True)
+def _multi_branch(enc, i, j, bi, bj, E, DANGLES, luts):
+    """Free energy of a multi-branch loop closed by (i,j), using the linear formula of Jaeger, Turner, and Zuker, 1989
+
+    Unpaired bases next to a branch count as a dangling end. A single unpaired base goes to whichever of
+    the two neighbouring branches has the more favorable energy. Without unpaired bases coaxial stacking is
+    made favorable.
+
+    bi, bj hold the branches sorted by their leftmost index, (i,j) included as first branch.
+    DANGLES[i',j'] holds the dangling end energies of each base pair returned by _dangles.
+    """
+
+    k = bi.shape[0]
+    unpaired = 0
+    e_sum = 0.0
+    for index in range(k):
+        i2, j2 = bi[index], bj[index]
+        i1, j1 = bi[(index - 1 + k) % k], bj[(index - 1 + k) % k]
+        i3, j3 = bi[(index + 1) % k], bj[(index + 1) % k]
+        unpaired_right = 0
+        de = 0.0
+
+        if index == k - 1:
+            unpaired_left = i2 - j1 - 1
+            unpaired_right = j3 - j2 - 1
+            if unpaired_left and unpaired_right:
+                de = DANGLES[i2, j2, 0]
+            elif unpaired_right:
+                de = DANGLES[i2, j2, 1]
+                if unpaired_right == 1:
+                    de = min(DANGLES[i3, j3, 5], de)
+        elif index == 0:
+            unpaired_left = j2 - j1 - 1
+            unpaired_right = i3 - i2 - 1
+            if unpaired_left and unpaired_right:
+                de = DANGLES[i2, j2, 3]
+            elif unpaired_right:
+                de = DANGLES[i2, j2, 4]
+                if unpaired_right == 1:
+                    de = min(DANGLES[i3, j3, 2], de)
+        else:
+            unpaired_left = i2 - j1 - 1 if index > 1 else i2 - i1 - 1
+            unpaired_right = i3 - j2 - 1
+            if unpaired_left and unpaired_right:
+                de = DANGLES[i2, j2, 0]
+            elif unpaired_right:
+                de = DANGLES[i2, j2, 1]
+                if unpaired_right == 1:
+                    de = min(DANGLES[i3, j3, 2], de)
+
+        e_sum += de
+        unpaired += unpaired_right
+        if index != 0:
+            e_sum += E[i2, j2]
+
+    # penalty for unmatched bp and multi-branch
+    a, b, c, d = luts[8][0], luts[8][1], luts[8][2], luts[8][3]
+    e_multibranch = a + b * k + c * unpaired
+    if unpaired == 0: #make coxial stacking favorable
+        e_multibranch = a - d
+
+    return e_multibranch + e_sum
+
+
+@njit(cache=True)
+def _precedes(rank, r, other, r_other):
+    """Whether the combination of candidates rank[:r] comes before other[:r_other] when enumerating
+    the combinations by size and then in lexicographic order, as itertools.combinations does."""
+
+    if r != r_other:
+        return r < r_other
+    for q in range(r):
+        if rank[q] != other[q]:
+            return rank[q] < other[q]
+    return False
+
+
+@njit(cache=True)
+def _mbranch_floor(luts, n_helices):
+    """Lower bound of the linear multi-branch penalty a + b * helices + c * unpaired (a - d if nothing is unpaired)
+    of a loop with up to n_helices helices."""
+
+    a, b, d = luts[8][0], luts[8][1], luts[8][3]
+    e_multibranch = a - d
+    for k in range(3, n_helices + 1):
+        e_multibranch = min(e_multibranch, a + b * k)
+    return e_multibranch
+
+
+@njit(cache=True)
+def _dangle_floor(enc, i, i1, j, j1, luts):
+    """Lower bound of the dangling end or stack energy (de in _multi_branch) that a helix adds to a multi-branch loop.
+
+    (i, i1, j, j1) are the outer pair of the helix and its neighbours as _multi_branch passes them to _stack:
+    (i2-1, i2, j2+1, j2) for a branch, (j-1, j, i+1, i) for the closing pair.
+    """
+
+    DE = luts[3]
+    de = min(0.0, np.nanmin(DE[:, :, GAP, :]))
+    de = min(de, _stack(enc, i, i1, j, j1, luts))
+    de = min(de, _stack(enc, -1, i1, j, j1, luts))
+    return de
+
+
+@njit(cache=True)
+def _e(enc, i, j, E, DESC, BP_I, BP_J, NB, S, ISO_OUT, ISO_IN, HP, DE_FLOOR, DANGLES, mb_floor, luts):
+    """Find and store the minimum free energy of the structure between i and j
+
+    Returns:
+        float: The minimum free energy. DESC[i,j], BP_I[i,j] and BP_J[i,j] are filled with the type and the inner base pairs of the optimal face.
+    """
+
+    n = enc.shape[0]
+    n_children = BP_I.shape[2]
+    NN = luts[0]
+    S_ptr, S_bp_i, S_bp_j = S
+    start, stop = S_ptr[i * n + j], S_ptr[i * n + j + 1]
+
+    # if the basepair is isolated, and the seq large, penalize at 5000 kcal/mol
+    isolated_outer = ISO_OUT[i, j]
+    if isolated_outer and ISO_IN[i, j]:
+        E[i, j] = ISOLATED_PENALTY
+        return E[i, j]
+
+    # E1 = FH(i, j); hairpin
+    e1 = HP[i, j]
+    if j - i == 4:  # small hairpin; 4bp
+        E[i, j] = e1
+        DESC[i, j] = HAIRPIN
+        return e1
+
+    # E2 = min{FL(i, j, i', j') + e(i', j')}, i<i'<j'<j
+    e2 = math.inf
+    e2_desc, e2_i, e2_j = 0, -1, -1
+    pair_left = not np.isnan(NN[enc[i], enc[i + 1], enc[j], enc[j - 1]])
+    for k in range(start, stop):
+        i1, j1 = S_bp_i[k], S_bp_j[k]
+        # i1 and j1 must match
+        if enc[i1] + enc[j1] != 3:
+            continue
+
+        # one branch per face type, the nearest neighbor of (i',j') is only looked up for interior loops
+        bulge_left = i1 > i + 1
+        bulge_right = j1 < j - 1
+        if not bulge_left and not bulge_right:
+            # it's a neighboring/stacking pair in a helix
+            e2_test = _stack(enc, i, i1, j, j1, luts)
+            e2_test_desc = STACK
+        elif bulge_left != bulge_right:
+            # it's a bulge
+            e2_test = _bulge(enc, i, i1, j, j1, luts)
+            e2_test_desc = BULGE
+        elif not pair_left and np.isnan(NN[enc[i1 - 1], enc[i1], enc[j1 + 1], enc[j1]]):
+            # it's an interior loop
+            e2_test = _internal_loop(enc, i, i1, j, j1, luts)
+            e2_test_desc = INTERIOR
+        else:
+            # it's basically a hairpin, only outside bp match
+            continue
+
+        # add e(i', j')
+        e2_test += E[i1, j1]
+        if e2_test != -math.inf and e2_test < e2:
+            e2 = e2_test
+            e2_desc, e2_i, e2_j = e2_test_desc, i1, j1
+
+    # E3 = min{FB(i, j, branches) + \sum_{(i',j') \in branches}e(i', j')} with i<i'<j'<j
+    e3 = math.inf
+    e3_i = np.full(n_children, -1, dtype=np.int32)
+    e3_j = np.full(n_children, -1, dtype=np.int32)
+    if not isolated_outer or not i or j == n - 1:
+        # Consider all i<i'<j'<j and remove those that cannot be branches
+        cells = S_bp_i[start:stop] * n + S_bp_j[start:stop]
+        keep = NB[cells] == 0
+        ci, cj, cells = S_bp_i[start:stop][keep], S_bp_j[start:stop][keep], cells[keep]
+        ce = E.reshape(n * n)[cells] + DE_FLOOR.reshape(n * n)[cells]
+        m = ci.shape[0]
+
+        if m >= 2 and n_children >= 2:
+            # Depth first search over the combinations of up to n_children branches, visiting the branches
+            # by increasing energy. The energy of a combination is bounded from below by the energy of the
+            # chosen branches, the most negative ones that can still be added and the multi-branch penalty,
+            # each helix counted with the lowest dangling end energy it can add. Once the bound of a branch
+            # exceeds e3 so does the bound of all the following ones at the same depth.
+            floor = mb_floor + _dangle_floor(enc, j - 1, j, i + 1, i, luts)
+            order = np.argsort(ce[:m], kind='mergesort')
+            K = min(n_children, m)
+            combo = np.empty(K, dtype=np.int64)
+            psum = np.zeros(K + 1)
+            rank = np.empty(K, dtype=np.int64)
+            e3_rank = np.empty(K, dtype=np.int64)
+            e3_r = 0
+            bi = np.empty(K + 1, dtype=np.int32)
+            bj = np.empty(K + 1, dtype=np.int32)
+            bi[0] = i
+            bj[0] = j
+            lvl = 0
+            combo[0] = -1
+            while lvl >= 0:
+                combo[lvl] += 1
+                k = combo[lvl]
+                if k >= m:
+                    lvl -= 1
+                    continue
+                p = psum[lvl] + ce[order[k]]
+                lb = p + floor
+                for q in range(k + 1, min(k + K - lvl, m)):
+                    if ce[order[q]] >= 0:
+                        break
+                    lb += ce[order[q]]
+                if lb > e3:
+                    lvl -= 1
+                    continue
+                psum[lvl + 1] = p
+                r = lvl + 1
+
+                # sort the combination by leftmost index, keep the candidates order to break ties
+                for q in range(r):
+                    c = order[combo[q]]
+                    bi[q + 1] = ci[c]
+                    bj[q + 1] = cj[c]
+                    t = q + 1
+                    while t > 1 and bi[t - 1] > bi[t]:
+                        bi[t - 1], bi[t] = bi[t], bi[t - 1]
+                        bj[t - 1], bj[t] = bj[t], bj[t - 1]
+                        t -= 1
+                    rank[q] = c
+                    t = q
+                    while t > 0 and rank[t - 1] > rank[t]:
+                        rank[t - 1], rank[t] = rank[t], rank[t - 1]
+                        t -= 1
+
+                # branches must not intersect, neither can any extension of an intersecting combination
+                intersect = False
+                for q in range(2, r + 1):
+                    if bi[q] <= bj[q - 1]:
+                        intersect = True
+                        break
+                if intersect:
+                    continue
+
+                if r >= 2:
+                    e3_test = _multi_branch(enc, i, j, bi[:r + 1], bj[:r + 1], E, DANGLES, luts)
+                    if e3_test != math.inf and e3_test != -math.inf and (e3_test < e3 or e3_test == e3 and _precedes(rank, r, e3_rank, e3_r)):
+                        e3 = e3_test
+                        e3_r = r
+                        e3_rank[:r] = rank[:r]
+                        e3_i[:] = -1
+                        e3_j[:] = -1
+                        e3_i[:r] = bi[1:r + 1]
+                        e3_j[:r] = bj[1:r + 1]
+
+                if r < K:
+                    lvl += 1
+                    combo[lvl] = k
+
+    # select the minimum, the hairpin wins ties
+    e = math.inf
+    which = 0
+    if e1 != -math.inf and e1 < e:
+        e = e1
+        which = 1
+    if e2 != -math.inf and e2 < e:
+        e = e2
+        which = 2
+    if e3 != -math.inf and e3 < e:
+        e = e3
+        which = 3
+
+    # If face has positive energy, is a multi-branch or an hairpin, it is not considered as a branch candidate in multi-branch loops
+    if e > 0 or which != 2:
+        NB[i * n + j] = 1
+
+    if which == 1:
+        DESC[i, j] = HAIRPIN
+    elif which == 2:
+        DESC[i, j] = e2_desc
+        BP_I[i, j, 0] = e2_i
+        BP_J[i, j, 0] = e2_j
+    elif which == 3:
+        DESC[i, j] = MBRANCH
+        BP_I[i, j, :] = e3_i
+        BP_J[i, j, :] = e3_j
+    E[i, j] = e
+    return e
+
+
+@njit(cache=True)
+def _fill_stem(enc, E, DESC, BP_I, BP_J, STEM, luts):
+    """Fill the base pairs (k,n-1-k) of the initial stem, each one can only stack on the next one.
+
+    The stem is a straight diagonal, so its free energies are the cumulative sum of the stacking energies
+    starting from the free energy of the innermost base pair (m,n-1-m), with m = len(STEM).
+
+    Args:
+        STEM: STEM[k] is True if (k,n-1-k) is one of the base pairs found solving the graph matching problem
+    """
+
+    n = enc.shape[0]
+    m = STEM.shape[0]
+    e = np.empty(m + 1)
+    e[0] = E[m, n - 1 - m]
+    for k in range(m):
+        e[m - k] = _stack(enc, k, k + 1, n - 1 - k, n - 2 - k, luts)
+    e = np.cumsum(e)
+
+    broken = False
+    for k in range(m - 1, -1, -1):
+        # (k+1,n-2-k) must be a base pair
+        if not STEM[k] or enc[k + 1] + enc[n - 2 - k] != 3:
+            broken = True
+            continue
+        if not broken and e[m - k] != -math.inf and e[m - k] < math.inf:
+            E[k, n - 1 - k] = e[m - k]
+            DESC[k, n - 1 - k] = STACK
+            BP_I[k, n - 1 - k, 0] = k + 1
+            BP_J[k, n - 1 - k, 0] = n - 2 - k
+        else:
+            # the stem is broken somewhere inside
+            E[k, n - 1 - k] = math.inf
+            broken = True
+
+
+@njit(cache=True, parallel=True)
+def _fill(enc, S, D, l_fix, n_branches, ISO_OUT, ISO_IN, luts):
+    """Fill the energy cache diagonal by diagonal.
+
+    Every (i,j) on diagonal d = j - i only depends on base pairs (i',j') with i<i'<j'<j, which lie on
+    shorter diagonals and are therefore already filled, so the base pairs of a diagonal are filled in parallel.
+
+    Args:
+        enc: The encoded sequence
+        S: (S_ptr, S_bp_i, S_bp_j) for each base pair (i,j), all base pairs (i',j') such that i<i'<j'<j are
+            S_bp_i[k], S_bp_j[k] for k in range(S_ptr[i*n+j], S_ptr[i*n+j+1])
+        D: (D_ptr, D_bp_i, D_bp_j) base pairs with length d are D_bp_i[k], D_bp_j[k] for k in range(D_ptr[d], D_ptr[d+1])
+        l_fix: length of initial stem. Forces the first l_fix nucleotides to base pair with the last l_fix nucleotides.
+        n_branches: amount of branches to consider when computing multi-branch loops
+        ISO_OUT, ISO_IN: masks of the isolated base pairs returned by isolated_masks
+        luts: lookup tables returned by energy_luts
+
+    Returns:
+        E: n x n free energies, -inf where (i,j) is not a base pair
+        DESC: n x n type of the optimal face closed by (i,j): HAIRPIN, STACK, BULGE, INTERIOR or MBRANCH
+        BP_I, BP_J: n x n x (n_branches-1) inner base pairs (i',j') of each face, padded with -1
+        min_i, min_j, min_e: base pair with the minimum free energy
+    """
+
+    n = enc.shape[0]
+    E = np.full((n, n), -math.inf)
+    DESC = np.zeros((n, n), dtype=np.uint8)
+    BP_I = np.full((n, n, max(n_branches - 1, 1)), -1, dtype=np.int32)
+    BP_J = np.full((n, n, max(n_branches - 1, 1)), -1, dtype=np.int32)
+    NB = np.zeros(n * n, dtype=np.uint8)
+    D_ptr, D_bp_i, D_bp_j = D
+    # energies that only depend on the base pair, computed in one pass
+    HP = np.full((n, n), math.inf)
+    DE_FLOOR = np.zeros((n, n))
+    DANGLES = np.zeros((n, n, N_DANGLES))
+    STEM = np.zeros(max(0, min(l_fix - 1, (n - 1) // 2)), dtype=np.bool_)
+    for k in range(D_bp_i.shape[0]):
+        i, j = D_bp_i[k], D_bp_j[k]
+        HP[i, j] = _hairpin(enc, i, j, luts)
+        DE_FLOOR[i, j] = _dangle_floor(enc, i - 1, i, j + 1, j, luts)
+        DANGLES[i, j] = _dangles(enc, i, j, luts)
+        if i == n - 1 - j and i < STEM.shape[0]:
+            STEM[i] = True
+    mb_floor = _mbranch_floor(luts, BP_I.shape[2] + 1)
+    CELL_E = np.full(D_bp_i.shape[0], math.nan)
+
+    for d in range(n):
+        if STEM.shape[0] and d == n + 1 - 2 * STEM.shape[0]:
+            # every base pair inside the stem is filled
+            _fill_stem(enc, E, DESC, BP_I, BP_J, STEM, luts)
+        # base pairs on the same diagonal are independent, each one only writes its own cell
+        for k in prange(D_ptr[d], D_ptr[d + 1]):
+            i, j = D_bp_i[k], D_bp_j[k]
+            if i == n - 1 - j and i < STEM.shape[0]:
+                if DESC[i, j] == STACK:
+                    CELL_E[k] = E[i, j]
+            else:
+                CELL_E[k] = _e(enc, i, j, E, DESC, BP_I, BP_J, NB, S, ISO_OUT, ISO_IN, HP, DE_FLOOR, DANGLES, mb_floor, luts)
+
+    # the first base pair in fill order wins ties
+    min_e = math.inf
+    min_i, min_j = -1, -1
+    for k in range(CELL_E.shape[0]):
+        if CELL_E[k] < min_e:
+            min_e = CELL_E[k]
+            min_i, min_j = D_bp_i[k], D_bp_j[k]
+
+    return E, DESC, BP_I, BP_J, min_i, min_j, min_e
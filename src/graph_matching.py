@@ -78,18 +78,12 @@ class Aptamer_match():
     
     def create_dict_d(self,):
         '''Create dictionary containing for each possible length d = |i-j| all base pairs with length d 
-            identified solving the subgraph matching problem
+            identified solving the subgraph matching problem. Keys are sorted in ascending order and base pairs by i.
         '''
-        self.dict_d = {}
-        
-        for bp in self.bps:
-                    try:
-                        self.dict_d[str(bp[1]-bp[0])].add(bp)
-                        
-                    except KeyError:
-                        self.dict_d[str(bp[1]-bp[0])] = set([])
-                        
-                        self.dict_d[str(bp[1]-bp[0])].add(bp)
+        bps = np.array(self.bps, dtype=np.int32).reshape(-1, 2)
+        bps = bps[np.lexsort((bps[:, 0], bps[:, 1] - bps[:, 0]))]
+        lengths, starts = np.unique(bps[:, 1] - bps[:, 0], return_index=True)
+        self.dict_d = {int(d): bps_d for d, bps_d in zip(lengths, np.split(bps, starts[1:]))}
         return  
     
     def create_dict_Sij(self, ):
@@ -133,8 +127,8 @@ class Aptamer_match():
                 self.bps (set): A set containing all non-isolated base pairs.
                 self.dict_Sij (dict): A dictionary where each key is a base pair (i, j) identified by solving the graph matching problem. 
                                     The corresponding value is a list of all possible base pairs (i', j') such that i < i' < j' < j.
-                self.dict_d (dict): A dictionary where each key is a possible distance d = |i - j| (the length of a base pair) and the value 
-                                    is a list of all base pairs of that length identified by solving the subgraph matching problem.
+                self.dict_d (dict): A dictionary where each key is a possible distance d = |i - j| (the length of a base pair), in ascending order, and the value 
+                                    is an m x 2 array of all base pairs of that length identified by solving the subgraph matching problem, sorted by i.
             """
 
             self.l_fix= l_fix # number of fixed base pairs 